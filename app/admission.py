@@ -0,0 +1,342 @@
+"""
+Admission control for the planning endpoints.
+
+Each request's token cost is estimated from its chunk count before any LLM
+call is made, then charged against request and token budgets over a sliding
+window. Over-budget requests are rejected with a Retry-After hint instead of
+queueing behind everyone else.
+
+Callers with a key from TENANT_API_KEYS get their own tenant budget. Everyone
+else is budgeted per client IP and, together, against one global anonymous
+budget, so rotating IPs or headers cannot get around the limits.
+
+Budgets live in process memory by default. Set ADMISSION_REDIS_URL to share
+them across instances through any Redis-compatible server.
+"""
+import os
+import math
+import hashlib
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from app.constants import EXTRACTOR_SYSTEM_PROMPT
+
+WINDOW_SECONDS = int(os.getenv("ADMISSION_WINDOW_SECONDS", 60))
+TENANT_REQUESTS_PER_WINDOW = int(os.getenv("TENANT_REQUESTS_PER_WINDOW", 30))
+TENANT_TOKENS_PER_WINDOW = int(os.getenv("TENANT_TOKENS_PER_WINDOW", 2_000_000))
+# Per client IP, for callers without an API key
+ANON_IP_REQUESTS_PER_WINDOW = int(os.getenv("ANON_IP_REQUESTS_PER_WINDOW", 10))
+ANON_IP_TOKENS_PER_WINDOW = int(os.getenv("ANON_IP_TOKENS_PER_WINDOW", 500_000))
+# Shared by all callers without an API key
+ANON_REQUESTS_PER_WINDOW = int(os.getenv("ANON_REQUESTS_PER_WINDOW", 30))
+ANON_TOKENS_PER_WINDOW = int(os.getenv("ANON_TOKENS_PER_WINDOW", 2_000_000))
+# A single request estimated above this is refused outright (413)
+MAX_REQUEST_TOKENS = int(os.getenv("MAX_REQUEST_TOKENS", 1_000_000))
+# Requests above this share a small "heavy" lane so they can't crowd out small ones
+HEAVY_REQUEST_TOKENS = int(os.getenv("HEAVY_REQUEST_TOKENS", 200_000))
+HEAVY_LANE_SLOTS = int(os.getenv("HEAVY_LANE_SLOTS", 1))
+REDIS_URL = os.getenv("ADMISSION_REDIS_URL")
+# "key1:tenant-a,key2:tenant-b"
+TENANT_API_KEYS = os.getenv("TENANT_API_KEYS", "")
+# Proxies in front of the app that append to X-Forwarded-For (1 on Cloud Run)
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", 0))
+
+CHARS_PER_TOKEN = 4
+# Typical extractor response size per chunk
+EXPECTED_OUTPUT_TOKENS_PER_CHUNK = 400
+# Raw pipeline output is capped at max_output_tokens, budget for a large share of it
+EXPECTED_RAW_OUTPUT_TOKENS = 16_384
+# Planner prompt + max output, and generator prompt + plan + max output
+EXPECTED_PLANNER_TOKENS = 700
+EXPECTED_GENERATE_TOKENS = 1500
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is over budget; status_code and retry_after describe the response."""
+
+    def __init__(self, message: str, status_code: int = 429, retry_after: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def estimate_plan_tokens(chunk_count: int, chunk_chars: int = 1000) -> int:
+    """Input + expected output tokens for running the extractor over chunk_count chunks."""
+    per_chunk = (len(EXTRACTOR_SYSTEM_PROMPT) + chunk_chars) // CHARS_PER_TOKEN + EXPECTED_OUTPUT_TOKENS_PER_CHUNK
+    return chunk_count * per_chunk
+
+
+def estimate_raw_tokens(doc_chars: int) -> int:
+    """Single-shot cost: the whole document in, one large response out."""
+    return doc_chars // CHARS_PER_TOKEN + EXPECTED_RAW_OUTPUT_TOKENS
+
+
+def estimate_generate_tokens(input_chars: int, attempts: int = 3) -> int:
+    """Planner call plus every allowed generator attempt (prompt + plan in, max output out)."""
+    planner_tokens = input_chars // CHARS_PER_TOKEN + EXPECTED_PLANNER_TOKENS
+    return planner_tokens + attempts * EXPECTED_GENERATE_TOKENS
+
+
+def chunk_count_for_size(size_bytes: int, chunk_chars: int = 1000) -> int:
+    """Upper-bound chunk count for a document known only by size (streamed uploads)."""
+    # Chunks are packed to roughly three quarters of chunk_chars on real specs
+    return max(1, math.ceil(size_bytes / (chunk_chars * 3 // 4)))
+
+
+def estimate_upload_tokens(pipeline: str, size_bytes: int) -> int:
+    if pipeline == "raw":
+        return estimate_raw_tokens(size_bytes)
+    return estimate_plan_tokens(chunk_count_for_size(size_bytes))
+
+
+def max_upload_bytes(pipeline: str, buckets=None) -> int:
+    """
+    Largest decoded upload whose estimate fits MAX_REQUEST_TOKENS and every
+    bucket's token budget, i.e. the effective size cap for this caller.
+    """
+    limit = min([MAX_REQUEST_TOKENS] + [max_tokens for _, _, max_tokens in buckets or []])
+    if pipeline == "raw":
+        return max(0, (limit - EXPECTED_RAW_OUTPUT_TOKENS) * CHARS_PER_TOKEN)
+    chunks = limit // estimate_plan_tokens(1)
+    return chunks * (1000 * 3 // 4)
+
+
+# Tenant identification
+
+def _parse_api_keys(spec: str) -> dict:
+    keys = {}
+    for pair in filter(None, (p.strip() for p in spec.split(","))):
+        key, _, tenant = pair.partition(":")
+        if key and tenant:
+            keys[hashlib.sha256(key.encode()).hexdigest()] = tenant
+    return keys
+
+
+_api_keys = _parse_api_keys(TENANT_API_KEYS)
+
+
+def client_ip(forwarded_for: str, peer: str) -> str:
+    """
+    Client address as seen by the outermost trusted proxy.
+
+    Each trusted proxy appends the address it received the request from, so the
+    entry TRUSTED_PROXY_HOPS from the right is the real client; anything further
+    left was supplied by the client and is ignored.
+    """
+    if TRUSTED_PROXY_HOPS and forwarded_for:
+        hops = [h.strip() for h in forwarded_for.split(",") if h.strip()]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return peer or "unknown"
+
+
+def buckets_for(api_key: str, forwarded_for: str, peer: str) -> list:
+    """
+    Budget buckets for a caller: [(bucket_key, max_requests, max_tokens), ...].
+
+    Raises AdmissionRejected(401) for an API key that is not configured.
+    """
+    if api_key:
+        tenant = _api_keys.get(hashlib.sha256(api_key.encode()).hexdigest())
+        if tenant is None:
+            raise AdmissionRejected("Unknown API key", status_code=401)
+        return [(f"tenant:{tenant}", TENANT_REQUESTS_PER_WINDOW, TENANT_TOKENS_PER_WINDOW)]
+    return [
+        (f"anon-ip:{client_ip(forwarded_for, peer)}", ANON_IP_REQUESTS_PER_WINDOW, ANON_IP_TOKENS_PER_WINDOW),
+        ("anonymous", ANON_REQUESTS_PER_WINDOW, ANON_TOKENS_PER_WINDOW),
+    ]
+
+
+# Sliding-window stores
+
+class SlidingWindowStore:
+    """In-process sliding windows of (timestamp, tokens, requests) entries per bucket."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._last_sweep = 0.0
+
+    def try_acquire(self, buckets, tokens: int, count_request: bool, window: int, now: float = None):
+        """
+        Record the charge in every bucket if it fits all of them; otherwise
+        record nothing and return the seconds until it would fit.
+        """
+        now = time.time() if now is None else now
+        requests = 1 if count_request else 0
+        with self._lock:
+            if now - self._last_sweep >= window:
+                self._sweep(now, window)
+            waits = []
+            for key, max_requests, max_tokens in buckets:
+                entries = self._entries.get(key, ())
+                while entries and entries[0][0] <= now - window:
+                    entries.popleft()
+                wait = _retry_after(entries, tokens, requests, max_requests, max_tokens, window, now)
+                if wait is not None:
+                    waits.append(wait)
+            if waits:
+                return max(waits)
+            for key, _, _ in buckets:
+                self._entries.setdefault(key, deque()).append((now, tokens, requests))
+            return None
+
+    def _sweep(self, now: float, window: int):
+        """Drop buckets whose newest entry has aged out (e.g. one-off anon-ip keys)."""
+        for key in [k for k, entries in self._entries.items() if not entries or entries[-1][0] <= now - window]:
+            del self._entries[key]
+        self._last_sweep = now
+
+
+def _retry_after(entries, tokens, requests, max_requests, max_tokens, window, now):
+    """Seconds until enough oldest entries expire for the charge to fit, or None if it fits now."""
+    used_requests = sum(r for _, _, r in entries)
+    used_tokens = sum(t for _, t, _ in entries)
+    if used_requests + requests <= max_requests and used_tokens + tokens <= max_tokens:
+        return None
+    for ts, t, r in entries:
+        used_requests -= r
+        used_tokens -= t
+        if used_requests + requests <= max_requests and used_tokens + tokens <= max_tokens:
+            return max(0.0, ts + window - now)
+    return float(window)
+
+
+# KEYS = bucket zsets; ARGV = now, window, tokens, requests, member, then
+# max_requests, max_tokens per key. Members are "<uuid>:<tokens>:<requests>"
+# scored by timestamp; same algorithm as SlidingWindowStore.
+_REDIS_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local tokens = tonumber(ARGV[3])
+local requests = tonumber(ARGV[4])
+local wait = nil
+for k = 1, #KEYS do
+  local max_requests = tonumber(ARGV[4 + 2 * k])
+  local max_tokens = tonumber(ARGV[5 + 2 * k])
+  redis.call('ZREMRANGEBYSCORE', KEYS[k], '-inf', now - window)
+  local entries = redis.call('ZRANGE', KEYS[k], 0, -1, 'WITHSCORES')
+  local used_requests, used_tokens = 0, 0
+  for i = 1, #entries, 2 do
+    local t, r = string.match(entries[i], ':(%d+):(%d+)$')
+    used_tokens = used_tokens + tonumber(t)
+    used_requests = used_requests + tonumber(r)
+  end
+  if used_requests + requests > max_requests or used_tokens + tokens > max_tokens then
+    local bucket_wait = window
+    for i = 1, #entries, 2 do
+      local t, r = string.match(entries[i], ':(%d+):(%d+)$')
+      used_tokens = used_tokens - tonumber(t)
+      used_requests = used_requests - tonumber(r)
+      if used_requests + requests <= max_requests and used_tokens + tokens <= max_tokens then
+        bucket_wait = math.max(0, tonumber(entries[i + 1]) + window - now)
+        break
+      end
+    end
+    if wait == nil or bucket_wait > wait then wait = bucket_wait end
+  end
+end
+if wait ~= nil then return tostring(wait) end
+for k = 1, #KEYS do
+  redis.call('ZADD', KEYS[k], now, ARGV[5])
+  redis.call('EXPIRE', KEYS[k], window)
+end
+return '-1'
+"""
+
+
+class RedisSlidingWindowStore:
+    """Same contract as SlidingWindowStore, backed by a Redis-compatible server."""
+
+    def __init__(self, url: str):
+        import redis
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(_REDIS_SCRIPT)
+
+    def try_acquire(self, buckets, tokens: int, count_request: bool, window: int, now: float = None):
+        now = time.time() if now is None else now
+        requests = 1 if count_request else 0
+        member = f"{uuid.uuid4().hex}:{int(tokens)}:{requests}"
+        args = [now, window, int(tokens), requests, member]
+        for _, max_requests, max_tokens in buckets:
+            args += [max_requests, max_tokens]
+        result = float(self._script(keys=[f"admission:{key}" for key, _, _ in buckets], args=args))
+        return None if result < 0 else result
+
+
+# Store singleton (lazy initialized)
+_store = None
+_heavy_lane = threading.BoundedSemaphore(HEAVY_LANE_SLOTS)
+
+
+def _get_store():
+    global _store
+    if _store is None:
+        _store = RedisSlidingWindowStore(REDIS_URL) if REDIS_URL else SlidingWindowStore()
+    return _store
+
+
+class Admission:
+    """
+    An admitted request. The first charge counts the request; top_up charges
+    extra tokens once the real size is known (e.g. after an upload is decoded).
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.tokens = 0
+        self.heavy = False
+        self._counted = False
+
+    def charge(self, tokens: int):
+        total = self.tokens + tokens
+        limit = min([MAX_REQUEST_TOKENS] + [max_tokens for _, _, max_tokens in self.buckets])
+        if total > limit:
+            raise AdmissionRejected(f"Estimated {total} tokens exceeds the per-request limit of {limit}", status_code=413)
+
+        took_lane = False
+        if total > HEAVY_REQUEST_TOKENS and not self.heavy:
+            if not _heavy_lane.acquire(blocking=False):
+                raise AdmissionRejected("Large-document lane is busy", retry_after=WINDOW_SECONDS)
+            self.heavy = took_lane = True
+
+        retry_after = _get_store().try_acquire(self.buckets, tokens, not self._counted, WINDOW_SECONDS)
+        if retry_after is not None:
+            if took_lane:
+                self.release()
+            raise AdmissionRejected(
+                f"Over the request/token budget for {self.buckets[0][0]}", retry_after=max(1, math.ceil(retry_after))
+            )
+        self._counted = True
+        self.tokens = total
+
+    def top_up(self, tokens: int):
+        """Raise the charge to tokens if the new estimate exceeds what was already charged."""
+        if tokens > self.tokens:
+            self.charge(tokens - self.tokens)
+
+    def release(self):
+        if self.heavy:
+            self.heavy = False
+            _heavy_lane.release()
+
+
+@contextmanager
+def admit(buckets, tokens: int):
+    """
+    Charge a request against its budgets and yield the Admission.
+
+    The sliding-window charge is recorded once, at admission time, and ages
+    out of the window on its own; only the heavy-lane slot is held until the
+    block exits. Raises AdmissionRejected (429 + retry_after, or 413 for a
+    request that could never fit) without blocking.
+    """
+    admission = Admission(buckets)
+    try:
+        admission.charge(tokens)
+        print(f"[Admission] {buckets[0][0]}: admitted ~{tokens} tokens{' (heavy lane)' if admission.heavy else ''}")
+        yield admission
+    finally:
+        admission.release()
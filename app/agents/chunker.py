@@ -1,38 +1,36 @@
-def chunk_text(text: str, max_chars=1000):
+def _refine_paragraph(p: str, max_chars: int):
     """
-    Chunk text into manageable pieces, respecting natural boundaries where possible.
+    Break a single paragraph down into pieces no longer than max_chars.
     """
-    # First split by double newlines (paragraphs)
-    paragraphs = text.split("\n\n")
-    
-    refined_paragraphs = []
-    
-    # Second pass: break down large paragraphs
-    for p in paragraphs:
-        if len(p) <= max_chars:
-            refined_paragraphs.append(p)
+    if len(p) <= max_chars:
+        yield p
+        return
+
+    # Split by single newline
+    lines = p.split("\n")
+    for line in lines:
+        if len(line) <= max_chars:
+            yield line
         else:
-            # Split by single newline
-            lines = p.split("\n")
-            for line in lines:
-                if len(line) <= max_chars:
-                    refined_paragraphs.append(line)
+            # Split by sentences (naive)
+            sentences = line.split(". ")
+            for sent in sentences:
+                # Re-add the dot if it wasn't the last one
+                if sent != sentences[-1]:
+                    sent += "."
+
+                if len(sent) <= max_chars:
+                    yield sent
                 else:
-                    # Split by sentences (naive)
-                    sentences = line.split(". ")
-                    for sent in sentences:
-                        # Re-add the dot if it wasn't the last one
-                        if sent != sentences[-1]:
-                            sent += "."
-                        
-                        if len(sent) <= max_chars:
-                            refined_paragraphs.append(sent)
-                        else:
-                            # Hard split
-                            for i in range(0, len(sent), max_chars):
-                                refined_paragraphs.append(sent[i:i + max_chars])
-
-    chunks = []
+                    # Hard split
+                    for i in range(0, len(sent), max_chars):
+                        yield sent[i:i + max_chars]
+
+
+def _pack(refined_paragraphs, max_chars: int):
+    """
+    Greedily pack refined paragraphs into chunks of up to max_chars.
+    """
     current = ""
 
     for p in refined_paragraphs:
@@ -41,10 +39,59 @@ def chunk_text(text: str, max_chars=1000):
             current += p + "\n\n"
         else:
             if current.strip():
-                chunks.append(current.strip())
+                yield current.strip()
             current = p + "\n\n"
 
     if current.strip():
-        chunks.append(current.strip())
+        yield current.strip()
+
+
+def chunk_text(text: str, max_chars=1000):
+    """
+    Chunk text into manageable pieces, respecting natural boundaries where possible.
+    """
+    # First split by double newlines (paragraphs), then break down large paragraphs
+    refined_paragraphs = (piece for p in text.split("\n\n") for piece in _refine_paragraph(p, max_chars))
+    return list(_pack(refined_paragraphs, max_chars))
+
+
+def _stream_paragraphs(blocks, max_buffer: int):
+    """
+    Split an iterable of text blocks on double newlines without joining them.
+
+    A paragraph that grows past max_buffer without a blank line is flushed at
+    its last single newline (or hard cut), so the buffer stays bounded.
+    """
+    buffer = ""
+    for block in blocks:
+        buffer += block
+        while True:
+            idx = buffer.find("\n\n")
+            if idx != -1:
+                yield buffer[:idx]
+                buffer = buffer[idx + 2:]
+            elif len(buffer) > max_buffer:
+                cut = buffer.rfind("\n")
+                if cut <= 0:
+                    cut = max_buffer
+                    yield buffer[:cut]
+                    buffer = buffer[cut:]
+                else:
+                    yield buffer[:cut]
+                    buffer = buffer[cut + 1:]
+            else:
+                break
+    yield buffer
+
 
-    return chunks
+def chunk_stream(blocks, max_chars=1000):
+    """
+    Incremental variant of chunk_text for documents that do not fit in memory.
+
+    Takes an iterable of text blocks (e.g. reads from a file) and yields the same
+    chunks chunk_text would produce for the concatenated text, holding at most
+    a few paragraphs in memory at a time.
+    """
+    paragraphs = _stream_paragraphs(blocks, max_buffer=max_chars * 64)
+    refined_paragraphs = (piece for p in paragraphs for piece in _refine_paragraph(p, max_chars))
+    yield from _pack(refined_paragraphs, max_chars)
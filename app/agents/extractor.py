@@ -3,8 +3,12 @@ import re
 from google.genai import types
 from app.llm_client import client
 from app.constants import EXTRACTOR_SYSTEM_PROMPT, MODEL
+from app.context_cache import SYSTEM_PROMPT_TTL_SECONDS, get_manager, prefix_key, usage_tokens
 from app.util.json_repair import repair_json
 
+# The system prompt is identical on every call, so it is the cacheable prefix
+_PROMPT_CACHE_KEY = prefix_key("extractor", EXTRACTOR_SYSTEM_PROMPT)
+
 EXTRACTOR_SCHEMA = {
     "type": "object",
     "properties": {
@@ -24,19 +28,31 @@ EXTRACTOR_SCHEMA = {
     "required": ["extracted_rules"]
 }
 
+def _generate(chunk: str, cached_content: str = None):
+    return client.models.generate_content(
+        model=MODEL,
+        contents=[
+            {"role": "user", "parts": [{"text": f"DOCUMENT CHUNK:\n{chunk}"}]},
+        ],
+        config=types.GenerateContentConfig(
+            # A cached handle already carries the system instruction
+            cached_content=cached_content,
+            system_instruction=None if cached_content else EXTRACTOR_SYSTEM_PROMPT,
+            temperature=0.0,
+            max_output_tokens=8192,
+            response_mime_type="application/json",
+            response_schema=EXTRACTOR_SCHEMA,
+        ),
+    )
+
+
 def extract_rules(chunk: str) -> dict:
     try:
-        response = client.models.generate_content(
-            model=MODEL,
-            contents=[
-                {"role": "user", "parts": [{"text": f"{EXTRACTOR_SYSTEM_PROMPT}\n\nDOCUMENT CHUNK:\n{chunk}"}]},
-            ],
-            config=types.GenerateContentConfig(
-                temperature=0.0,
-                max_output_tokens=8192,
-                response_mime_type="application/json",
-                response_schema=EXTRACTOR_SCHEMA,
-            ),
+        response = get_manager().call(
+            _PROMPT_CACHE_KEY,
+            SYSTEM_PROMPT_TTL_SECONDS,
+            lambda cached_content: _generate(chunk, cached_content),
+            system_instruction=EXTRACTOR_SYSTEM_PROMPT,
         )
 
         raw_text = response.text
@@ -44,9 +60,10 @@ def extract_rules(chunk: str) -> dict:
         print(f"[Extractor] Error generating content: {e}")
         return {"extracted_rules": []}
 
+    usage = usage_tokens(getattr(response, "usage_metadata", None))
     if not raw_text or not raw_text.strip():
         print("[Extractor] Warning: Empty response from LLM")
-        return {"extracted_rules": []}
+        return {"extracted_rules": [], "usage": usage}
 
     # Strip markdown code blocks if present
     text = raw_text.strip()
@@ -55,7 +72,7 @@ def extract_rules(chunk: str) -> dict:
         text = re.sub(r'\s*```$', '', text)
 
     try:
-        return json.loads(text)
+        return {**json.loads(text), "usage": usage}
     except json.JSONDecodeError:
         print(f"[Extractor] JSON parse error. Attempting repair.")
         try:
@@ -67,8 +84,8 @@ def extract_rules(chunk: str) -> dict:
         try:
             repaired = repair_json(text)
             print(f"[Extractor] Repaired JSON (tail): {repaired[-50:]}")
-            return json.loads(repaired)
+            return {**json.loads(repaired), "usage": usage}
         except json.JSONDecodeError as e:
             print(f"[Extractor] Repair failed: {e}")
-            return {"extracted_rules": []}
+            return {"extracted_rules": [], "usage": usage}
 
@@ -1,14 +1,19 @@
-from app.llm_client import client, MODEL
-from app.constants import GENERATOR_SYSTEM_PROMPT
+from app.llm_client import client
+from app.constants import GENERATOR_SYSTEM_PROMPT, MODEL
 
 
-def generate(plan: dict) -> str:
+def generate(plan: dict, feedback: str = None) -> str:
     from google.genai import types
 
+    prompt = f"{GENERATOR_SYSTEM_PROMPT}\n\nPLAN:\n{plan}"
+    if feedback:
+        # Validator feedback from the previous attempt
+        prompt += f"\n\nPREVIOUS OUTPUT WAS REJECTED:\n{feedback}"
+
     response = client.models.generate_content(
         model=MODEL,
         contents=[
-            {"role": "user", "parts": [{"text": f"{GENERATOR_SYSTEM_PROMPT}\n\nPLAN:\n{plan}"}]},
+            {"role": "user", "parts": [{"text": prompt}]},
         ],
         config=types.GenerateContentConfig(
             temperature=0.1,
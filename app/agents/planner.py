@@ -1,7 +1,8 @@
 import json
 import time
 import re
-from app.llm_client import client, MODEL
+from app.llm_client import client
+from app.constants import MODEL
 from google.genai import types
 
 PLANNER_SYSTEM_PROMPT = """
@@ -0,0 +1,228 @@
+"""
+Deterministic pre-filter that decides which chunks are worth an extraction call.
+
+Chunks are scored from normative-language signals (modal verbs, requirement
+keywords, numeric limits). Depending on the mode, chunks without enough signal
+are skipped outright or batched together into a single extraction call:
+
+- off:          every chunk is extracted on its own.
+- conservative: only signal-free boilerplate (TOC, changelog, examples) is
+                skipped; every other weak chunk is batched.
+- aggressive:   chunks below the threshold are skipped.
+"""
+import re
+import hashlib
+from app.constants import EXTRACTOR_SYSTEM_PROMPT
+
+MODES = ("off", "conservative", "aggressive")
+
+# Score at or above which a chunk gets its own extraction call
+STRONG_SCORE = 2.0
+# Max characters of weak chunks combined into one batched call
+BATCH_MAX_CHARS = 4000
+
+_STRONG = re.compile(
+    r"\b(must|shall|required|requires|mandatory|prohibited|forbidden|"
+    r"must not|shall not|may not|cannot|can not|not allowed|not permitted|never)\b",
+    re.IGNORECASE,
+)
+_WEAK = re.compile(
+    r"\b(should|should not|only|always|enforce[sd]?|expires?|exceed(s|ed)?|"
+    r"reject(s|ed)?|limit(s|ed)?|max(imum)?|min(imum)?|at (most|least)|up to|no more than|"
+    r"allowed|valid|invalid|ensure|guarantee[sd]?)\b",
+    re.IGNORECASE,
+)
+_NUMERIC_LIMIT = re.compile(
+    r"\b\d[\d,.]*\s*(%|ms|milliseconds?|s|sec(onds?)?|minutes?|hours?|days?|"
+    r"[kmg]i?b|bytes?|chars?|characters?|requests?|calls?|attempts?|retries|rps|rpm|items?)\b",
+    re.IGNORECASE,
+)
+# Non-normative boilerplate: TOC leaders, and sections whose heading names a
+# changelog, examples, acknowledgements, etc.
+_TOC_LINE = re.compile(r"(\.{4,}|…{2,})\s*\d+\s*$", re.MULTILINE)
+_BOILERPLATE_HEADING = re.compile(
+    r"\b(table of contents|contents|change ?log|revision history|release notes|"
+    r"examples?|sample (request|response)s?|acknowledg(e)?ments?|glossary|references)\b",
+    re.IGNORECASE,
+)
+
+
+def is_boilerplate(chunk: str) -> bool:
+    """True for tables of contents and sections headed as changelog/examples/etc."""
+    lines = [line for line in chunk.splitlines() if line.strip()]
+    if not lines:
+        return True
+    if len(_TOC_LINE.findall(chunk)) * 2 >= len(lines):
+        return True
+    return bool(_BOILERPLATE_HEADING.search(lines[0]))
+
+
+def score_chunk(chunk: str) -> float:
+    """Score how likely a chunk is to contain extractable rules (0 = no signal)."""
+    strong = len(_STRONG.findall(chunk))
+    weak = len(_WEAK.findall(chunk))
+    numeric = len(_NUMERIC_LIMIT.findall(chunk))
+    score = 2.0 * strong + 1.0 * weak + 1.0 * numeric
+    if is_boilerplate(chunk):
+        score *= 0.5
+    return score
+
+
+def classify(chunk: str, mode: str = "conservative") -> str:
+    """Return "extract", "batch" or "skip" for a chunk under the given mode."""
+    if mode == "off":
+        return "extract"
+    return _classify_score(score_chunk(chunk), is_boilerplate(chunk), mode)
+
+
+def _classify_score(score: float, boilerplate: bool, mode: str) -> str:
+    if mode == "off" or score >= STRONG_SCORE:
+        return "extract"
+    if mode == "aggressive" or (score == 0 and boilerplate):
+        return "skip"
+    return "batch"
+
+
+def chunk_hash(chunk: str) -> str:
+    """Short content hash used to join a filtered run's batches with a full run's chunks."""
+    return hashlib.sha256(chunk.encode()).hexdigest()[:16]
+
+
+def chunk_record(chunk: str) -> dict:
+    """Compact per-chunk record (no text) that measure_recall can replay."""
+    return {
+        "sha256": chunk_hash(chunk),
+        "chars": len(chunk),
+        "score": score_chunk(chunk),
+        "boilerplate": is_boilerplate(chunk),
+    }
+
+
+def _estimate_tokens(text: str) -> int:
+    # ~4 chars per token; good enough for reporting savings
+    return len(text) // 4
+
+
+def filter_chunks(chunks, mode: str = "conservative", stats: dict = None):
+    """
+    Yield (text, members) for each extraction call: a single chunk with
+    members=None, or a batch of chunks with members listing their chunk_hash.
+
+    Works on any iterable so streamed documents stay streamed. If a stats dict
+    is passed it is filled with chunks_total / chunks_skipped / chunks_batched /
+    calls_saved / tokens_saved as the generator is consumed.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown prefilter mode: {mode}")
+    if stats is None:
+        stats = {}
+    stats.update({"mode": mode, "chunks_total": 0, "chunks_skipped": 0, "chunks_batched": 0,
+                  "calls_saved": 0, "tokens_saved": 0})
+    prompt_tokens = _estimate_tokens(EXTRACTOR_SYSTEM_PROMPT)
+
+    batch = []
+    batch_chars = 0
+
+    def flush():
+        nonlocal batch, batch_chars
+        combined = "\n\n".join(batch), [chunk_hash(c) for c in batch]
+        stats["calls_saved"] += len(batch) - 1
+        stats["tokens_saved"] += (len(batch) - 1) * prompt_tokens
+        batch, batch_chars = [], 0
+        return combined
+
+    for chunk in chunks:
+        stats["chunks_total"] += 1
+        action = classify(chunk, mode)
+        if action == "extract":
+            yield chunk, None
+        elif action == "skip":
+            stats["chunks_skipped"] += 1
+            stats["calls_saved"] += 1
+            stats["tokens_saved"] += prompt_tokens + _estimate_tokens(chunk)
+        else:
+            if batch and batch_chars + len(chunk) > BATCH_MAX_CHARS:
+                yield flush()
+            batch.append(chunk)
+            batch_chars += len(chunk)
+            stats["chunks_batched"] += 1
+
+    if batch:
+        yield flush()
+
+
+def measure_recall(chunk_results, mode: str = "conservative", batch_results=None) -> dict:
+    """
+    Measure what a mode would lose against a cached full (mode="off") run.
+
+    chunk_results is the "chunk_results" artifact saved by the executor: one
+    chunk_record per chunk plus the number of rules it produced. Skipped
+    chunks count as lost.
+
+    batch_results is the "batch_results" artifact of a run of the same
+    document in this mode: member hashes and rule count per batched call.
+    Each batch is joined with its members' individual rule counts and
+    credited with at most that many rules. Batched chunks not covered by
+    batch_results are reported as unmeasured and left out of recall.
+    """
+    rules = {"extract": 0, "batch": 0, "skip": 0}
+    chunks = {"extract": 0, "batch": 0, "skip": 0}
+    by_hash = {}
+    for r in chunk_results:
+        action = _classify_score(r["score"], r["boilerplate"], mode)
+        rules[action] += r["rules"]
+        chunks[action] += 1
+        by_hash[r["sha256"]] = r["rules"]
+
+    individual = joint = 0
+    batches_measured = batches_unmatched = 0
+    for b in batch_results or []:
+        if not all(h in by_hash for h in b["members"]):
+            batches_unmatched += 1
+            continue
+        batch_individual = sum(by_hash[h] for h in b["members"])
+        individual += batch_individual
+        joint += min(b["rules"], batch_individual)
+        batches_measured += 1
+
+    rules_total = rules["extract"] + rules["skip"] + rules["batch"]
+    measured = rules["extract"] + rules["skip"] + individual
+    kept = rules["extract"] + joint
+    return {
+        "mode": mode,
+        "chunks_total": len(chunk_results),
+        "chunks_skipped": chunks["skip"],
+        "chunks_batched": chunks["batch"],
+        "rules_total": rules_total,
+        "rules_lost": rules["skip"] + individual - joint,
+        # Rules of batched chunks when extracted one by one vs. in their batch
+        "batches_measured": batches_measured,
+        "batches_unmatched": batches_unmatched,
+        "rules_batched_individual": individual,
+        "rules_batched_joint": joint,
+        "batch_recall": round(joint / individual, 4) if individual else 1.0,
+        # Recall over extracted, skipped and measured batched chunks
+        "recall": round(kept / measured, 4) if measured else 1.0,
+        # Rules from batched chunks with no batch record; recall for them is unmeasured
+        "rules_batched_unmeasured": max(0, rules["batch"] - individual),
+        # Guaranteed-kept share if every unmeasured batched rule were lost
+        "recall_lower_bound": round(kept / rules_total, 4) if rules_total else 1.0,
+    }
+
+
+if __name__ == "__main__":
+    # Recall check against a cached full run:
+    #   python -m app.agents.prefilter <off_doc_id> [<filtered_doc_id>]
+    # where <off_doc_id> is a run made with PREFILTER_MODE=off and the optional
+    # <filtered_doc_id> a conservative/aggressive run of the same document.
+    import json
+    import sys
+    from app.store import load_artifact
+
+    records = json.loads(load_artifact(sys.argv[1], "chunk_results"))["chunks"]
+    if len(sys.argv) > 2:
+        filtered = json.loads(load_artifact(sys.argv[2], "batch_results"))
+        print(json.dumps(measure_recall(records, filtered["mode"], filtered["batches"])))
+    else:
+        for m in MODES:
+            print(json.dumps(measure_recall(records, m)))
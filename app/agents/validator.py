@@ -1,10 +1,22 @@
+MAX_OUTPUT_CHARS = 1000
+
+# Instructions fed back to the generator for each issue
+ISSUE_FEEDBACK = {
+    "empty": "The output was empty. Produce the requested result.",
+    "too_long": f"The output exceeded {MAX_OUTPUT_CHARS} characters. Shorten it.",
+}
+
+
 def validate(output: str, plan: dict = None) -> dict:
-    """Validate output against the plan. Currently checks length only."""
+    """Validate output against the plan. Currently checks emptiness and length only."""
     issues = []
-    if len(output) > 1000:
+    if not output or not output.strip():
+        issues.append("empty")
+    elif len(output) > MAX_OUTPUT_CHARS:
         issues.append("too_long")
 
     return {
         "valid": len(issues) == 0,
-        "issues": issues
+        "issues": issues,
+        "feedback": "\n".join(ISSUE_FEEDBACK[i] for i in issues),
     }
@@ -1,16 +1,146 @@
-from fastapi import FastAPI, Body
-from app.executor import doc_to_plan
+from fastapi import FastAPI, Body, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from app import admission, ingest
+from app.agents import chunker
+from app.executor import FIXTURE_PATH, MAX_GENERATE_RETRIES, chunks_to_plan, dedup_pipeline, file_to_plan, generate_pipeline
+from app.plan_cache import cache as generate_cache
 from app.raw_plan_handler import raw_plan_handler
+from app.store import save_plan
 
 endpoint = FastAPI()
 
+
+def _http_error(e: admission.AdmissionRejected) -> HTTPException:
+    headers = {"Retry-After": str(e.retry_after)} if e.retry_after is not None else None
+    return HTTPException(status_code=e.status_code, detail=str(e), headers=headers)
+
+
+class _Admitted:
+    """Context manager wrapping admission.admit that surfaces rejections (including top-ups) as HTTP errors."""
+
+    def __init__(self, request: Request, tokens: int):
+        try:
+            buckets = admission.buckets_for(
+                request.headers.get("x-api-key"),
+                request.headers.get("x-forwarded-for"),
+                request.client.host if request.client else None,
+            )
+        except admission.AdmissionRejected as e:
+            raise _http_error(e)
+        self._cm = admission.admit(buckets, tokens)
+
+    def __enter__(self):
+        try:
+            return self._cm.__enter__()
+        except admission.AdmissionRejected as e:
+            raise _http_error(e)
+
+    def __exit__(self, exc_type, exc, tb):
+        self._cm.__exit__(exc_type, exc, tb)
+        if isinstance(exc, admission.AdmissionRejected):
+            raise _http_error(exc) from exc
+        return False
+
+
 @endpoint.post("/plan")
-def plan(req: dict = Body(default={})):
+def plan(request: Request, req: dict = Body(default={})):
     doc = req.get("doc", "")
     name = req.get("name", "demo-doc")
-    return doc_to_plan(doc)
+    chunks = chunker.chunk_text(doc or FIXTURE_PATH.read_text())
+    with _Admitted(request, admission.estimate_plan_tokens(len(chunks))):
+        return chunks_to_plan(chunks)
 
 @endpoint.post("/process-raw")
-def process_raw(req: dict = Body(default={})):
+def process_raw(request: Request, req: dict = Body(default={})):
     doc = req.get("doc", "")
-    return raw_plan_handler(doc)
\ No newline at end of file
+    doc_chars = len(doc) if doc else FIXTURE_PATH.stat().st_size
+    with _Admitted(request, admission.estimate_raw_tokens(doc_chars)):
+        return raw_plan_handler(doc)
+
+@endpoint.post("/generate")
+def generate(request: Request, req: dict = Body(default={})):
+    user_input = req.get("input", "")
+    if not user_input:
+        raise HTTPException(status_code=400, detail="'input' is required")
+    tokens = admission.estimate_generate_tokens(len(user_input), attempts=MAX_GENERATE_RETRIES + 1)
+    with _Admitted(request, tokens):
+        return generate_pipeline(user_input)
+
+@endpoint.get("/generate/metrics")
+def generate_metrics():
+    return generate_cache.metrics()
+
+
+def _raw_from_file(path, content_hash):
+    result = raw_plan_handler(ingest.read_text(path))
+    if "error" not in result:
+        result["content_hash"] = content_hash
+        save_plan(result, ingest.dedup_plan_name("raw", content_hash))
+    return result
+
+
+_UPLOAD_PIPELINES = {
+    "plan": file_to_plan,
+    "raw": _raw_from_file,
+}
+
+
+async def _spool_request(request: Request, max_bytes: int) -> ingest.UploadSpool:
+    """Stream an application/octet-stream (plain or gzip) body to a temp file."""
+    gzipped = True if request.headers.get("content-encoding") == "gzip" else None
+    spool = ingest.UploadSpool(max_bytes=max_bytes, gzipped=gzipped)
+    try:
+        # gunzip, hashing and the disk write are blocking; keep them off the event loop
+        async for block in request.stream():
+            await run_in_threadpool(spool.write, block)
+        await run_in_threadpool(spool.close)
+    except Exception:
+        spool.cleanup()
+        raise
+    return spool
+
+
+async def _run_upload(pipeline: str, request: Request):
+    content_length = request.headers.get("content-length")
+    try:
+        ingest.check_content_length(content_length)
+    except ingest.UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+    # Admit on the declared size before reading the body, so over-budget
+    # callers get a fast 429/413; re-checked against the decoded size below.
+    declared = int(content_length) if content_length and content_length.isdigit() else 0
+    declared_tokens = admission.estimate_upload_tokens(pipeline, declared) if declared else 0
+    with _Admitted(request, declared_tokens) as admitted:
+        # Chunked and gzip bodies are only sized once decoded, so the spool
+        # itself stops at the largest document this caller could be admitted for
+        max_bytes = min(ingest.MAX_UPLOAD_BYTES, admission.max_upload_bytes(pipeline, admitted.buckets))
+        try:
+            spool = await _spool_request(request, max_bytes)
+        except ingest.UploadTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        except (ValueError, OSError) as e:
+            # zlib.error is an OSError subclass; truncated gzip is a ValueError
+            raise HTTPException(status_code=400, detail=f"Invalid upload: {e}")
+
+        try:
+            dedup_key = dedup_pipeline() if pipeline == "plan" else pipeline
+            cached = ingest.load_deduped_plan(dedup_key, spool.content_hash)
+            if cached is not None:
+                print(f"[Upload] Reusing {pipeline} result for {spool.content_hash[:12]}")
+                return {**cached, "deduplicated": True}
+            print(f"[Upload] {pipeline}: {spool.size} bytes, sha256={spool.content_hash[:12]}")
+            # gzip bodies decode to more than Content-Length declared
+            admitted.top_up(admission.estimate_upload_tokens(pipeline, spool.size))
+            return await run_in_threadpool(_UPLOAD_PIPELINES[pipeline], spool.path, content_hash=spool.content_hash)
+        finally:
+            spool.cleanup()
+
+
+@endpoint.post("/plan/upload")
+async def plan_upload(request: Request):
+    return await _run_upload("plan", request)
+
+@endpoint.post("/process-raw/upload")
+async def process_raw_upload(request: Request):
+    return await _run_upload("raw", request)
@@ -0,0 +1,360 @@
+"""
+Context cache manager for stable prompt prefixes.
+
+Creates Gemini cached-content handles for prefixes that are resent on every
+call (the extractor system prompt, or a whole document for raw runs and
+follow-ups), tracks their TTL and reference counts, and reuses them across
+requests. Prefixes below the provider's minimum cache size, failed creates
+and handles that expired server-side all fall back to a plain uncached call.
+"""
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "1") == "1"
+# Explicit caches smaller than this are rejected by the API
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", 2048))
+SYSTEM_PROMPT_TTL_SECONDS = int(os.getenv("SYSTEM_PROMPT_CACHE_TTL", 3600))
+DOCUMENT_TTL_SECONDS = int(os.getenv("DOCUMENT_CACHE_TTL", 600))
+# A document is only cached once it has been sent this many times within its
+# TTL (a retry or a follow-up request), so one-shot documents never pay storage
+DOCUMENT_CACHE_MIN_USES = int(os.getenv("DOCUMENT_CACHE_MIN_USES", 2))
+# Handles this close to expiry get their TTL extended (or are recreated)
+REFRESH_MARGIN_SECONDS = 60
+MAX_ENTRIES = int(os.getenv("CONTEXT_CACHE_MAX_ENTRIES", 32))
+# Prefix keys remembered for min_uses counting
+MAX_SEEN_KEYS = 1024
+
+CHARS_PER_TOKEN = 4
+
+
+def prefix_key(*parts: str) -> str:
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update((part or "").encode())
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+def usage_tokens(usage_metadata) -> dict:
+    """Split a response's prompt tokens into cached and uncached input tokens."""
+    if usage_metadata is None:
+        return {"input_tokens": 0, "cached_tokens": 0, "uncached_tokens": 0}
+    prompt = getattr(usage_metadata, "prompt_token_count", None) or 0
+    cached = getattr(usage_metadata, "cached_content_token_count", None) or 0
+    return {"input_tokens": prompt, "cached_tokens": cached, "uncached_tokens": prompt - cached}
+
+
+def add_usage(total: dict, usage: dict):
+    for k, v in usage.items():
+        total[k] = total.get(k, 0) + v
+    return total
+
+
+def _is_cache_miss(exc: Exception) -> bool:
+    """Heuristic for "the cached content behind this handle is gone"."""
+    message = str(exc).lower()
+    return "cache" in message and ("not found" in message or "expired" in message or "404" in message)
+
+
+class _Entry:
+    def __init__(self, name: str, expires_at: float, ttl: int):
+        self.name = name
+        self.expires_at = expires_at
+        self.ttl = ttl
+        self.refs = 0
+        self.last_used = time.time()
+
+
+class _Pending:
+    """A create/refresh in progress for one key; waiters read name once done is set."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.name = None
+
+
+class ContextCacheManager:
+    def __init__(self, client, model: str, min_tokens: int = CONTEXT_CACHE_MIN_TOKENS,
+                 enabled: bool = CONTEXT_CACHE_ENABLED, max_entries: int = MAX_ENTRIES):
+        self.client = client
+        self.model = model
+        self.min_tokens = min_tokens
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._pending = {}
+        self._seen = OrderedDict()
+        self.stats = {"creates": 0, "reuses": 0, "refreshes": 0, "fallbacks": 0,
+                      "skipped_small": 0, "skipped_cold": 0}
+
+    def acquire(self, key: str, ttl: int, system_instruction: str = None, contents: list = None,
+                min_uses: int = 1):
+        """
+        Return a cached-content name for the prefix (creating it if needed) and
+        take a reference on it, or None if the prefix should not be cached.
+        With min_uses > 1 no handle is created until the key has been asked
+        for that many times within ttl.
+        """
+        if not self.enabled:
+            return None
+        size = len(system_instruction or "") + sum(len(c) for c in (contents or []))
+        if size // CHARS_PER_TOKEN < self.min_tokens:
+            self._count("skipped_small")
+            return None
+
+        # Only the first caller for a key talks to the API; the others wait on
+        # its pending marker and share the result. No network call runs under
+        # self._lock, so other keys are never blocked behind a slow create.
+        with self._lock:
+            now = time.time()
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at - REFRESH_MARGIN_SECONDS > now:
+                return self._take(entry, now)
+            pending = self._pending.get(key)
+            if entry is None and pending is None and not self._seen_enough(key, ttl, min_uses, now):
+                self.stats["skipped_cold"] += 1
+                return None
+            owner = pending is None
+            if owner:
+                pending = self._pending[key] = _Pending()
+                victims = self._pick_victims() if entry is None else []
+
+        if not owner:
+            pending.done.wait()
+            with self._lock:
+                entry = self._entries.get(key)
+                if pending.name is None or entry is None or entry.name != pending.name:
+                    return None
+                return self._take(entry, time.time())
+
+        try:
+            if entry is not None and not self._refresh(entry):
+                entry = None
+                victims = self._drop(key)
+            if entry is None:
+                self._delete(victims)
+                entry = self._create(ttl, system_instruction, contents)
+            with self._lock:
+                if entry is None:
+                    self._entries.pop(key, None)
+                    return None
+                self._entries[key] = entry
+                pending.name = entry.name
+                entry.refs += 1
+                entry.last_used = time.time()
+                return entry.name
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            pending.done.set()
+
+    def release(self, key: str, name: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            # The key may have been invalidated and recreated since acquire
+            if entry is not None and entry.name == name and entry.refs > 0:
+                entry.refs -= 1
+
+    def invalidate(self, key: str):
+        """Forget a handle the API no longer recognises; the next acquire recreates it."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    @contextmanager
+    def use(self, key: str, ttl: int, system_instruction: str = None, contents: list = None,
+            min_uses: int = 1):
+        name = self.acquire(key, ttl, system_instruction, contents, min_uses)
+        try:
+            yield name
+        finally:
+            if name is not None:
+                self.release(key, name)
+
+    def call(self, key: str, ttl: int, fn, system_instruction: str = None, contents: list = None,
+             min_uses: int = 1):
+        """
+        Run fn(cached_name_or_None) with a handle for the prefix. If the handle
+        turns out to be gone server-side, retry once uncached.
+        """
+        with self.use(key, ttl, system_instruction, contents, min_uses) as name:
+            try:
+                return fn(name)
+            except Exception as e:
+                if name is None or not _is_cache_miss(e):
+                    raise
+                print(f"[ContextCache] Handle {name} unusable ({e}); falling back to uncached call")
+                self.invalidate(key)
+                self._count("fallbacks")
+                return fn(None)
+
+    def _count(self, stat: str):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _seen_enough(self, key, ttl, min_uses, now):
+        """Caller holds self._lock. Record a request for key; True once it reaches min_uses."""
+        if min_uses <= 1:
+            return True
+        count, expires_at = self._seen.pop(key, (0, 0))
+        if expires_at <= now:
+            count, expires_at = 0, now + ttl
+        count += 1
+        self._seen[key] = (count, expires_at)
+        while len(self._seen) > MAX_SEEN_KEYS:
+            self._seen.popitem(last=False)
+        return count >= min_uses
+
+    def _take(self, entry, now):
+        # Caller holds self._lock
+        self.stats["reuses"] += 1
+        entry.refs += 1
+        entry.last_used = now
+        return entry.name
+
+    def _create(self, ttl, system_instruction, contents):
+        config = {"ttl": f"{ttl}s"}
+        if system_instruction:
+            config["system_instruction"] = system_instruction
+        if contents:
+            config["contents"] = [{"role": "user", "parts": [{"text": c}]} for c in contents]
+        try:
+            cached = self.client.caches.create(model=self.model, config=config)
+        except Exception as e:
+            print(f"[ContextCache] Create failed, using uncached calls: {e}")
+            self._count("fallbacks")
+            return None
+        self._count("creates")
+        print(f"[ContextCache] Created {cached.name} (ttl={ttl}s)")
+        return _Entry(cached.name, time.time() + ttl, ttl)
+
+    def _refresh(self, entry):
+        """Extend a nearly expired handle; returns False if it has to be recreated."""
+        if entry.expires_at <= time.time():
+            return False
+        try:
+            self.client.caches.update(name=entry.name, config={"ttl": f"{entry.ttl}s"})
+        except Exception as e:
+            print(f"[ContextCache] Refresh of {entry.name} failed: {e}")
+            return False
+        with self._lock:
+            entry.expires_at = time.time() + entry.ttl
+            self.stats["refreshes"] += 1
+        return True
+
+    def _drop(self, key):
+        """Forget an expired handle and pick eviction victims for its replacement."""
+        with self._lock:
+            # In-flight users keep their name (and fall back if it's gone)
+            self._entries.pop(key, None)
+            return self._pick_victims()
+
+    def _pick_victims(self):
+        """
+        Caller holds self._lock. Drop expired entries, then remove the least
+        recently used unreferenced ones over the limit and return those for
+        deletion outside the lock.
+        """
+        now = time.time()
+        for key in [k for k, e in self._entries.items() if e.expires_at <= now]:
+            del self._entries[key]
+        idle = sorted((e.last_used, k) for k, e in self._entries.items() if e.refs == 0)
+        victims = []
+        while len(self._entries) + len(self._pending) > self.max_entries and idle:
+            _, key = idle.pop(0)
+            victims.append(self._entries.pop(key))
+        return victims
+
+    def _delete(self, victims):
+        for entry in victims:
+            try:
+                self.client.caches.delete(name=entry.name)
+            except Exception as e:
+                print(f"[ContextCache] Delete of {entry.name} failed: {e}")
+
+
+# Manager singleton (lazy initialized)
+_manager = None
+
+
+def get_manager() -> ContextCacheManager:
+    global _manager
+    if _manager is None:
+        from app.llm_client import client
+        from app.constants import MODEL
+        _manager = ContextCacheManager(client, MODEL)
+    return _manager
+
+
+if __name__ == "__main__":
+    # Offline check with a fake client that bills cached input tokens at a
+    # quarter of the normal rate (Gemini 2.5 Flash pricing ratio).
+    from types import SimpleNamespace
+
+    INPUT_PRICE_PER_M = 0.30
+    CACHED_PRICE_PER_M = 0.075
+
+    class FakeClient:
+        def __init__(self):
+            self.stored = {}
+            self.caches = SimpleNamespace(create=self._create, update=self._update, delete=self._delete)
+            self.models = SimpleNamespace(generate_content=self._generate)
+
+        def _tokens(self, contents):
+            return sum(len(p["text"]) for c in contents for p in c["parts"]) // CHARS_PER_TOKEN
+
+        def _create(self, model, config):
+            name = f"cachedContents/{len(self.stored)}"
+            tokens = len(config.get("system_instruction") or "") // CHARS_PER_TOKEN
+            tokens += self._tokens(config.get("contents") or [])
+            self.stored[name] = tokens
+            return SimpleNamespace(name=name)
+
+        def _update(self, name, config):
+            if name not in self.stored:
+                raise RuntimeError(f"404 cached content {name} not found")
+
+        def _delete(self, name):
+            self.stored.pop(name, None)
+
+        def _generate(self, cached_content, contents):
+            if cached_content is not None and cached_content not in self.stored:
+                raise RuntimeError(f"404 cached content {cached_content} not found")
+            cached = self.stored.get(cached_content, 0)
+            usage = SimpleNamespace(prompt_token_count=cached + self._tokens(contents),
+                                    cached_content_token_count=cached)
+            return SimpleNamespace(text="{}", usage_metadata=usage)
+
+    def run(enabled):
+        fake = FakeClient()
+        manager = ContextCacheManager(fake, "fake-model", enabled=enabled)
+        document = "Clients MUST retry on 503. " * 8000  # ~54k tokens
+        key = prefix_key("document", document)
+        totals = {}
+        for i in range(5):
+            if i == 3:
+                fake.stored.clear()  # simulate server-side expiry
+            question = [{"role": "user", "parts": [{"text": f"Question {i}"}]}]
+
+            def call(name):
+                contents = question if name else [{"role": "user", "parts": [{"text": document}]}] + question
+                return fake.models.generate_content(cached_content=name, contents=contents)
+
+            response = manager.call(key, DOCUMENT_TTL_SECONDS, call, contents=[document],
+                                    min_uses=DOCUMENT_CACHE_MIN_USES)
+            add_usage(totals, usage_tokens(response.usage_metadata))
+        cost = (totals["uncached_tokens"] * INPUT_PRICE_PER_M + totals["cached_tokens"] * CACHED_PRICE_PER_M) / 1e6
+        print(f"cache {'on ' if enabled else 'off'}: {totals} stats={manager.stats} input_cost=${cost:.4f}")
+
+    run(False)
+    run(True)
+
+    # A document sent once is never cached
+    manager = ContextCacheManager(FakeClient(), "fake-model")
+    manager.acquire(prefix_key("one-shot"), DOCUMENT_TTL_SECONDS, contents=["x" * 40000],
+                    min_uses=DOCUMENT_CACHE_MIN_USES)
+    print(f"one-shot document: stats={manager.stats}")
@@ -1,40 +1,113 @@
+import os
+import time
 import uuid
 import concurrent.futures
 from pathlib import Path
-from app.agents import merger, chunker, conflict_dealer, extractor, normalizer, assemble
-from app.store import save_plan
+from app.agents import merger, chunker, conflict_dealer, extractor, normalizer, assemble, prefilter
+from app.agents import planner, generator, validator
+from app import ingest
+from app.context_cache import add_usage
+from app.plan_cache import cache as generate_cache
+from app.store import save_artifact, save_plan
 
-def doc_to_plan(text, version="v1"):
-    doc_id = str(uuid.uuid4())[:8]
+MAX_WORKERS = 10
+# Chunks queued per worker; keeps a streamed document from being submitted all at once
+MAX_IN_FLIGHT = MAX_WORKERS * 4
+# off | conservative | aggressive (see app/agents/prefilter.py)
+PREFILTER_MODE = os.getenv("PREFILTER_MODE", "conservative")
+FIXTURE_PATH = Path(__file__).parent / "fixture" / "apispec.txt"
+# Regenerations allowed after the first attempt fails validation
+MAX_GENERATE_RETRIES = int(os.getenv("MAX_GENERATE_RETRIES", 2))
+
+
+def doc_to_plan(text, version="v1", prefilter_mode=None):
     if not text:
         # Read default fixture file
-        fixture_path = Path(__file__).parent / "fixture" / "apispec.txt"
-        text = fixture_path.read_text()
-    chunks = chunker.chunk_text(text)
-    extracted = []
-
-    print(f"Starting extraction for {len(chunks)} chunks...")
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        # Map chunks to executor
-        future_to_chunk = {executor.submit(extractor.extract_rules, chunk): i for i, chunk in enumerate(chunks)}
-        
-        # Collect results as they complete (or strictly ordered)
-        results = [None] * len(chunks)
-        for future in concurrent.futures.as_completed(future_to_chunk):
-            index = future_to_chunk[future]
-            try:
-                result = future.result()
-                results[index] = result["extracted_rules"]
-                print(f"Chunk {index} finished. Rules: {len(result['extracted_rules'])}")
-            except Exception as exc:
-                print(f"Chunk {index} generated an exception: {exc}")
-                results[index] = []
-
-    # Flatten list
-    extracted = [extracted_rules for extracted_rules in results if extracted_rules]
+        text = FIXTURE_PATH.read_text()
+    return chunks_to_plan(chunker.chunk_text(text), version, prefilter_mode)
+
+
+def dedup_pipeline(prefilter_mode=None):
+    """Dedup key prefix for uploads; results from different prefilter modes are not interchangeable."""
+    return f"plan-{prefilter_mode or PREFILTER_MODE}"
+
+
+def file_to_plan(path, version="v1", content_hash=None, prefilter_mode=None):
+    """Run the pipeline over a spooled upload, chunking it incrementally from disk."""
+    plan = chunks_to_plan(chunker.chunk_stream(ingest.iter_text(path)), version, prefilter_mode)
+    if content_hash:
+        plan["content_hash"] = content_hash
+        save_plan(plan, ingest.dedup_plan_name(dedup_pipeline(prefilter_mode), content_hash))
+    return plan
+
+
+def chunks_to_plan(chunks, version="v1", prefilter_mode=None):
+    doc_id = str(uuid.uuid4())[:8]
+    prefilter_mode = prefilter_mode or PREFILTER_MODE
+    prefilter_stats = {}
+    chunks = prefilter.filter_chunks(chunks, prefilter_mode, prefilter_stats)
+    # Full (unfiltered) runs keep per-chunk scores and rule counts, filtered runs
+    # keep member hashes and rule counts per batch (never the text); joined by
+    # prefilter.measure_recall
+    chunk_results = [] if prefilter_mode == "off" else None
+    batch_results = [] if prefilter_mode != "off" else None
+
+    print(f"Starting extraction (prefilter={prefilter_mode})...")
+
+    results = {}
+    cache_usage = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        future_to_chunk = {}
+        chunk_iter = enumerate(chunks)
+
+        def submit_next():
+            for i, (chunk, members) in chunk_iter:
+                future_to_chunk[executor.submit(extractor.extract_rules, chunk)] = (i, chunk, members)
+                return True
+            return False
+
+        for _ in range(MAX_IN_FLIGHT):
+            if not submit_next():
+                break
+
+        # Collect results as they complete, topping the window back up each time
+        while future_to_chunk:
+            done, _ = concurrent.futures.wait(future_to_chunk, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                index, chunk, members = future_to_chunk.pop(future)
+                try:
+                    result = future.result()
+                    results[index] = result["extracted_rules"]
+                    add_usage(cache_usage, result.get("usage", {}))
+                    print(f"Chunk {index} finished. Rules: {len(result['extracted_rules'])}")
+                except Exception as exc:
+                    print(f"Chunk {index} generated an exception: {exc}")
+                    results[index] = []
+                if chunk_results is not None:
+                    chunk_results.append({"index": index, **prefilter.chunk_record(chunk), "rules": len(results[index])})
+                elif members is not None:
+                    batch_results.append({"index": index, "members": members, "rules": len(results[index])})
+                submit_next()
+
+    # Flatten list (in chunk order)
+    extracted = [results[i] for i in sorted(results) if results[i]]
 
     print("===============finished extracting==============")
+    print(
+        f"Prefilter: {prefilter_stats['chunks_skipped']}/{prefilter_stats['chunks_total']} chunks skipped, "
+        f"{prefilter_stats['chunks_batched']} batched, {prefilter_stats['calls_saved']} calls "
+        f"and ~{prefilter_stats['tokens_saved']} tokens saved"
+    )
+    print(
+        f"Input tokens: {cache_usage.get('cached_tokens', 0)} cached, "
+        f"{cache_usage.get('uncached_tokens', 0)} uncached"
+    )
+    if chunk_results is not None:
+        chunk_results.sort(key=lambda r: r["index"])
+        save_artifact(doc_id, "chunk_results", {"chunks": chunk_results})
+    if batch_results:
+        batch_results.sort(key=lambda r: r["index"])
+        save_artifact(doc_id, "batch_results", {"mode": prefilter_mode, "batches": batch_results})
     normalized = [normalizer.normalize_rule(r) for rules in extracted for r in rules]
     print("==================rule normalized=================")
     merged = merger.merge_rules([normalized])
@@ -42,9 +115,88 @@ def doc_to_plan(text, version="v1"):
     conflicts = conflict_dealer.detect_conflicts(merged)
     print("================conflict resolved================")
     plan = assemble.build_plan(doc_id, version, merged, conflicts)
+    plan["prefilter"] = prefilter_stats
+    plan["context_cache"] = cache_usage
     save_plan(plan, f"{doc_id}_plan.json")
     print("===============plan saved===================")
-    return plan    
+    return plan
+
+def generate_pipeline(user_input, max_retries=None):
+    """
+    Planner -> Generator -> Validator with bounded validator-feedback retries.
+
+    Plans are cached by normalized input and validated outputs by plan hash,
+    so a repeated request skips the planner (and generator) entirely. Every
+    attempt is saved as plan / output_<n> / validation_<n> artifacts.
+    """
+    run_id = str(uuid.uuid4())
+    max_retries = MAX_GENERATE_RETRIES if max_retries is None else max_retries
+    stages = {}
+
+    start = time.time()
+    plan, plan_cache = generate_cache.get_plan(user_input)
+    if plan is None:
+        planned = planner.plan(user_input)
+        plan = planned["plan"]
+        # Valid JSON that isn't an object is as unusable as unparseable JSON
+        if not isinstance(plan, dict):
+            print(f"[Generate] {run_id}: planner returned {type(plan).__name__}, rejecting")
+            plan = {"task": user_input, "status": "rejected", "constraints": [], "assumptions": [], "output_requirements": []}
+            planned["error"] = "Plan is not a JSON object"
+        # Only approved, well-formed plans are worth reusing
+        if "error" not in planned and plan.get("status") == "approved":
+            generate_cache.put_plan(user_input, plan)
+        # Only real planner calls count towards planner latency
+        generate_cache.record_latency("plan", time.time() - start)
+    stages["plan_sec"] = round(time.time() - start, 3)
+    save_artifact(run_id, "plan", plan)
+
+    result = {"run_id": run_id, "plan": plan, "plan_cache": plan_cache or "miss", "stages": stages}
+    if plan.get("status") != "approved":
+        result.update({"output": None, "valid": False, "attempts": 0})
+        return result
+
+    # A loose plan hit came from a differently worded request; regenerate
+    # rather than serve that request's output
+    cached_output = generate_cache.get_output(plan) if plan_cache != "loose" else None
+    if cached_output is not None:
+        print(f"[Generate] {run_id}: output cache hit")
+        result.update({"output": cached_output, "valid": True, "attempts": 0, "output_cache": "hit"})
+        return result
+
+    feedback = None
+    stages["generate_sec"] = stages["validate_sec"] = 0.0
+    for attempt in range(max_retries + 1):
+        start = time.time()
+        output = generator.generate(plan, feedback=feedback)
+        elapsed = time.time() - start
+        stages["generate_sec"] = round(stages["generate_sec"] + elapsed, 3)
+        generate_cache.record_latency("generate", elapsed)
+        save_artifact(run_id, f"output_{attempt}", {"output": output})
+
+        start = time.time()
+        validation = validator.validate(output, plan)
+        elapsed = time.time() - start
+        stages["validate_sec"] = round(stages["validate_sec"] + elapsed, 3)
+        generate_cache.record_latency("validate", elapsed)
+        save_artifact(run_id, f"validation_{attempt}", validation)
+
+        print(f"[Generate] {run_id}: attempt {attempt} valid={validation['valid']} issues={validation['issues']}")
+        if validation["valid"]:
+            if plan_cache != "loose":
+                generate_cache.put_output(plan, output)
+            break
+        feedback = validation["feedback"]
+
+    result.update({
+        "output": output,
+        "valid": validation["valid"],
+        "issues": validation["issues"],
+        "attempts": attempt + 1,
+        "output_cache": "skipped" if plan_cache == "loose" else "miss",
+    })
+    return result
+
 
 if __name__ == "__main__":
     doc_to_plan(None)
@@ -0,0 +1,192 @@
+"""
+Streaming ingestion for uploaded documents.
+
+Uploads are spooled block by block to a temp file (gunzipping on the fly),
+with the size limit enforced while writing and a sha256 of the decoded text
+recorded for dedup. The pipeline then reads the file back in blocks, so peak
+memory does not depend on document size.
+"""
+import os
+import codecs
+import hashlib
+import tempfile
+import zlib
+from app.store import load_plan
+
+# The spool lives in the temp dir, which on Cloud Run is in-memory and counts
+# against the instance's 512Mi; keep the default well inside that
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 64 * 1024 * 1024))
+READ_BLOCK_BYTES = 64 * 1024
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+class UploadTooLarge(ValueError):
+    """Raised when an upload exceeds MAX_UPLOAD_BYTES."""
+
+
+class UploadSpool:
+    """
+    Write-only spool for an upload arriving in blocks.
+
+    Usage:
+        spool = UploadSpool()
+        for block in body:
+            spool.write(block)
+        spool.close()
+        ... spool.path, spool.content_hash, spool.size ...
+        spool.cleanup()
+    """
+
+    def __init__(self, max_bytes: int = MAX_UPLOAD_BYTES, gzipped: bool = None):
+        self.max_bytes = max_bytes
+        # None means "sniff the gzip magic from the first block"
+        self.gzipped = gzipped
+        self.size = 0
+        self.content_hash = None
+        self._sha = hashlib.sha256()
+        self._decompressor = None
+        self._head = b""
+        fd, self.path = tempfile.mkstemp(prefix="upload-", suffix=".txt")
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, block: bytes):
+        if not block:
+            return
+        if self.gzipped is None:
+            # Sniff needs two bytes; hold back tiny leading blocks until then
+            self._head += block
+            if len(self._head) < len(_GZIP_MAGIC):
+                return
+            block, self._head = self._head, b""
+            self.gzipped = block[:2] == _GZIP_MAGIC
+        if self.gzipped:
+            if self._decompressor is None:
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            # Bound each inflate step so a small gzip bomb can't expand in one go
+            data = block
+            while data:
+                out = self._decompressor.decompress(data, READ_BLOCK_BYTES)
+                self._append(out)
+                data = self._decompressor.unconsumed_tail
+                if self._decompressor.eof and self._decompressor.unused_data:
+                    # Concatenated gzip members are valid; start the next one
+                    data = self._decompressor.unused_data
+                    self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._append(block)
+
+    def _append(self, data: bytes):
+        if not data:
+            return
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise UploadTooLarge(f"Upload exceeds {self.max_bytes} bytes")
+        self._sha.update(data)
+        self._file.write(data)
+
+    def close(self):
+        if self._head:
+            self.gzipped = False
+            self._append(self._head)
+        if self._decompressor is not None:
+            self._append(self._decompressor.flush())
+            if not self._decompressor.eof:
+                raise ValueError("Truncated gzip upload")
+        self._file.close()
+        self.content_hash = self._sha.hexdigest()
+
+    def cleanup(self):
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def check_content_length(header_value, max_bytes: int = MAX_UPLOAD_BYTES):
+    """Reject a declared Content-Length over the limit before reading the body."""
+    if header_value is None:
+        return
+    try:
+        declared = int(header_value)
+    except ValueError:
+        return
+    if declared > max_bytes:
+        raise UploadTooLarge(f"Upload exceeds {max_bytes} bytes")
+
+
+def iter_text(path: str, block_bytes: int = READ_BLOCK_BYTES):
+    """Yield the spooled document back as decoded text blocks."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_bytes)
+            if not block:
+                break
+            text = decoder.decode(block)
+            if text:
+                yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def read_text(path: str) -> str:
+    """Read the whole spooled document, for pipelines that need it in one prompt."""
+    with open(path, "rb") as f:
+        return f.read().decode("utf-8", errors="replace")
+
+
+def dedup_plan_name(pipeline: str, content_hash: str) -> str:
+    return f"{pipeline}_{content_hash}_plan.json"
+
+
+def load_deduped_plan(pipeline: str, content_hash: str):
+    """Return the plan previously produced for identical content, or None."""
+    try:
+        return load_plan(dedup_plan_name(pipeline, content_hash))
+    except FileNotFoundError:
+        return None
+
+
+if __name__ == "__main__":
+    # Memory benchmark: spool + chunk synthetic documents of increasing size and
+    # report tracemalloc peaks. Ingestion peak should stay flat across sizes.
+    import gzip
+    import time
+    import tracemalloc
+    from app.agents.chunker import chunk_stream
+
+    paragraph = (
+        "Clients MUST send an Idempotency-Key header on POST requests. "
+        "Requests larger than 1 MB shall be rejected with status 413.\n"
+        "See the example below for details.\n\n"
+    ).encode()
+
+    def body(total_bytes, compress):
+        payload = paragraph * (1024 * 1024 // len(paragraph) + 1)
+        payload = payload[:payload.rfind(b"\n\n") + 2]
+        sent = 0
+        while sent < total_bytes:
+            sent += len(payload)
+            yield gzip.compress(payload) if compress else payload
+
+    for compress in (False, True):
+        for mb in (10, 50, 100, 200):
+            tracemalloc.start()
+            start = time.time()
+            spool = UploadSpool(max_bytes=(mb + 1) * 1024 * 1024)
+            for block in body(mb * 1024 * 1024, compress):
+                spool.write(block)
+            spool.close()
+            chunks = sum(1 for _ in chunk_stream(iter_text(spool.path)))
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            spool.cleanup()
+            print(
+                f"{'gzip' if compress else 'text'} {mb:>4} MB: "
+                f"chunks={chunks} peak={peak / 1024 / 1024:.2f} MB "
+                f"elapsed={time.time() - start:.1f}s"
+            )
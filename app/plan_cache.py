@@ -0,0 +1,138 @@
+"""
+In-process caches for the generate pipeline.
+
+- Plan cache: planner output keyed by the normalized user input, with an
+  optional loose key that also ignores politeness/filler words.
+- Output cache: validated generator output keyed by the plan hash.
+
+Both are bounded LRUs. Stage latencies and hit/miss counters are kept
+alongside so repeated workloads can be checked for skipped planner calls.
+"""
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+PLAN_CACHE_SIZE = int(os.getenv("PLAN_CACHE_SIZE", 512))
+OUTPUT_CACHE_SIZE = int(os.getenv("OUTPUT_CACHE_SIZE", 512))
+# Also match requests that differ only in filler words ("please", "can you", ...)
+PLAN_CACHE_LOOSE_MATCH = os.getenv("PLAN_CACHE_LOOSE_MATCH", "0") == "1"
+
+# Words that never change what is being asked for. Negations, prepositions,
+# quantities and content words are deliberately absent, and word order is kept,
+# so "json to yaml" and "yaml to json" never share a key.
+_FILLER_WORDS = frozenset({
+    "a", "an", "the", "please", "kindly", "can", "could", "would", "you", "just",
+})
+
+
+def normalize_input(user_input: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation."""
+    text = re.sub(r"\s+", " ", (user_input or "").lower()).strip()
+    return text.rstrip(".!?")
+
+
+def loose_key(user_input: str) -> str:
+    """normalize_input with punctuation and filler words dropped, order kept."""
+    words = re.findall(r"\w+", normalize_input(user_input))
+    return " ".join(w for w in words if w not in _FILLER_WORDS)
+
+
+def plan_hash(plan: dict) -> str:
+    return hashlib.sha256(json.dumps(plan, sort_keys=True).encode()).hexdigest()
+
+
+class _LRU:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data = OrderedDict()
+
+    def get(self, key):
+        if key not in self._data:
+            return None
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+
+class GenerateCache:
+    def __init__(self, plan_size: int = PLAN_CACHE_SIZE, output_size: int = OUTPUT_CACHE_SIZE,
+                 loose_match: bool = PLAN_CACHE_LOOSE_MATCH):
+        self.loose_match = loose_match
+        self._lock = threading.Lock()
+        self._plans = _LRU(plan_size)
+        self._loose = _LRU(plan_size)
+        self._outputs = _LRU(output_size)
+        self._counters = {
+            "plan_hits_exact": 0, "plan_hits_loose": 0, "plan_misses": 0,
+            "output_hits": 0, "output_misses": 0,
+        }
+        self._latency = {}
+
+    def get_plan(self, user_input: str):
+        """
+        Return (plan, "exact" | "loose") for a cached plan, or (None, None).
+
+        A "loose" hit was planned for a differently worded request, so its
+        output must not be served from the output cache.
+        """
+        with self._lock:
+            plan = self._plans.get(normalize_input(user_input))
+            if plan is not None:
+                self._counters["plan_hits_exact"] += 1
+                return plan, "exact"
+
+            if self.loose_match:
+                plan = self._loose.get(loose_key(user_input))
+                if plan is not None:
+                    self._counters["plan_hits_loose"] += 1
+                    return plan, "loose"
+
+            self._counters["plan_misses"] += 1
+            return None, None
+
+    def put_plan(self, user_input: str, plan: dict):
+        with self._lock:
+            self._plans.put(normalize_input(user_input), plan)
+            self._loose.put(loose_key(user_input), plan)
+
+    def get_output(self, plan: dict):
+        with self._lock:
+            output = self._outputs.get(plan_hash(plan))
+            self._counters["output_hits" if output is not None else "output_misses"] += 1
+            return output
+
+    def put_output(self, plan: dict, output: str):
+        with self._lock:
+            self._outputs.put(plan_hash(plan), output)
+
+    def record_latency(self, stage: str, seconds: float):
+        with self._lock:
+            stats = self._latency.setdefault(stage, {"count": 0, "total_sec": 0.0, "max_sec": 0.0})
+            stats["count"] += 1
+            stats["total_sec"] += seconds
+            stats["max_sec"] = max(stats["max_sec"], seconds)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                **self._counters,
+                "latency": {
+                    stage: {
+                        "count": s["count"],
+                        "avg_sec": round(s["total_sec"] / s["count"], 3),
+                        "max_sec": round(s["max_sec"], 3),
+                    }
+                    for stage, s in self._latency.items()
+                },
+            }
+
+
+cache = GenerateCache()
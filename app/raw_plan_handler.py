@@ -11,6 +11,7 @@ import re
 from google.genai import types
 from app.constants import MODEL
 from app.llm_client import client
+from app.context_cache import DOCUMENT_CACHE_MIN_USES, DOCUMENT_TTL_SECONDS, get_manager, prefix_key, usage_tokens
 from app.store import save_plan
 from app.util.json_repair import repair_json
 from app.constants import RESPONSE_SCHEMA_FOR_PROCESS_RAW_DOC
@@ -32,7 +33,7 @@ def raw_plan_handler(document: str) -> dict:
         fixture_path = Path(__file__).parent / "fixture" / "apispec.txt"
         document = fixture_path.read_text()
 
-    prompt = f"""
+    instructions = """
 You are a document analysis system. Read the full Document.
 
 Extract explicit rules, constraints, requirements, or prohibitions.
@@ -44,48 +45,60 @@ Rules:
 - If nothing is extractable, return an empty list.
 
 Schema:
-{{
+{
   "rules": [
-    {{
+    {
       "type": "constraint | behavior | requirement | prohibition",
       "statement": "string",
       "confidence": "high | medium | low"
-    }}
+    }
   ]
-}}
-
-Document:
-{document}
+}
 """
+    document_text = f"Document:\n{document}"
+    document_part = {"role": "user", "parts": [{"text": document_text}]}
+    instruction_part = {"role": "user", "parts": [{"text": instructions}]}
+    # Keyed on the document alone so retries and follow-up calls share one handle
+    cache_key = prefix_key("document", document)
 
     max_retries = 2
     last_error = None
 
+    def stream(cached_content):
+        # Use streaming to handle long responses better and debug truncation
+        response_stream = client.models.generate_content_stream(
+            model=MODEL,
+            contents=[instruction_part] if cached_content else [document_part, instruction_part],
+            config=types.GenerateContentConfig(
+                cached_content=cached_content,
+                temperature=0.0,
+                response_mime_type="application/json",
+                response_schema=RESPONSE_SCHEMA_FOR_PROCESS_RAW_DOC,
+                max_output_tokens=65536,
+                http_options=types.HttpOptions(timeout=600_000),
+            ),
+        )
+
+        raw_text = ""
+        finish_reason = None
+        usage_metadata = None
+        for chunk in response_stream:
+            if chunk.text:
+                raw_text += chunk.text
+            if chunk.candidates and chunk.candidates[0].finish_reason:
+                finish_reason = chunk.candidates[0].finish_reason
+            if getattr(chunk, "usage_metadata", None):
+                usage_metadata = chunk.usage_metadata
+        return raw_text, finish_reason, usage_metadata
+
     for attempt in range(max_retries):
         try:
-            # Use streaming to handle long responses better and debug truncation
-            response_stream = client.models.generate_content_stream(
-                model=MODEL,
-                contents=[
-                    {"role": "user", "parts": [{"text": prompt}]}
-                ],
-                config=types.GenerateContentConfig(
-                    temperature=0.0,
-                    response_mime_type="application/json",
-                    response_schema=RESPONSE_SCHEMA_FOR_PROCESS_RAW_DOC,
-                    max_output_tokens=65536,
-                    http_options=types.HttpOptions(timeout=600_000),
-                ),
+            raw_text, finish_reason, usage_metadata = get_manager().call(
+                cache_key, DOCUMENT_TTL_SECONDS, stream, contents=[document_text],
+                min_uses=DOCUMENT_CACHE_MIN_USES,
             )
-
-            raw_text = ""
-            finish_reason = None
-            for chunk in response_stream:
-                if chunk.text:
-                    raw_text += chunk.text
-                if chunk.candidates and chunk.candidates[0].finish_reason:
-                    finish_reason = chunk.candidates[0].finish_reason
-            
+            usage = usage_tokens(usage_metadata)
+            print(f"[RawPlanHandler] Input tokens: {usage['cached_tokens']} cached, {usage['uncached_tokens']} uncached")
             print(f"[RawPlanHandler] Response length: {len(raw_text)}")
             if finish_reason:
                  print(f"[RawPlanHandler] Finish Reason: {finish_reason}")
@@ -123,6 +136,7 @@ Document:
             if "rules" not in result:
                 result["rules"] = []
             
+            result["context_cache"] = usage
             print(f"[RawPlanHandler] Rules extracted: {len(result.get('rules', []))}")
             save_plan(result, f"{doc_id}_plan.json")
             return result